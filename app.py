@@ -1,205 +1,351 @@
-# app.py
-import os
-import uuid
-import json
-from typing import List, Tuple, Dict, Any
-import gradio as gr
-from docx_utils import extract_structured_text, insert_comment_simulation, sanitize_filename
-from rag import SimpleRAGIndex
-from checker import heuristic_checks, document_level_checks, llm_review
-import shutil
-
-# Load checklist
-import json as _json
-with open("checklist.json","r",encoding="utf-8") as f:
-    CHECKLISTS = _json.load(f)
-
-# configure reference folder for RAG
-REF_FOLDER = "adgm_refs"
-rag_index = None
-if os.path.exists(REF_FOLDER):
-    rag_index = SimpleRAGIndex()
-    rag_index.build_from_folder(REF_FOLDER)
-else:
-    rag_index = None
-    print("Warning: adgm_refs folder not found. RAG disabled until you add reference .txt files to adgm_refs/")
-
-UPLOAD_DIR = "uploads"
-OUT_DIR = "outputs"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
-os.makedirs(OUT_DIR, exist_ok=True)
-
-DOC_TYPE_KEYWORDS = {
-    "Articles of Association": ["articles of association", "articles", "aoa"],
-    "Memorandum of Association": ["memorandum of association", "memorandum", "moa", "mou"],
-    "Incorporation Application Form": ["incorporation application", "incorporation form"],
-    "UBO Declaration Form": ["ubo declaration", "ubo form"],
-    "Register of Members and Directors": ["register of members", "register of directors", "register of members and directors"]
-}
-
-def detect_document_type(text: str) -> str:
-    txt = text.lower()
-    for doc_type, kws in DOC_TYPE_KEYWORDS.items():
-        for kw in kws:
-            if kw in txt:
-                return doc_type
-    # fallback simple guesses
-    if "article" in txt and "association" in txt:
-        return "Articles of Association"
-    if "memorandum" in txt:
-        return "Memorandum of Association"
-    return "Unknown Document Type"
-
-def process_uploaded_files(files):
-    """
-    files: list of (tempfile path, filename)
-    Returns paths to saved uploaded files
-    """
-    saved = []
-    for f in files:
-        tmp_path = f.name if hasattr(f, "name") else f[0]
-        original_name = getattr(f, "filename", None) or (f[1] if isinstance(f, tuple) else os.path.basename(tmp_path))
-        base = sanitize_filename(original_name)
-        dest = os.path.join(UPLOAD_DIR, f"{uuid.uuid4().hex}_{base}")
-        shutil.copy(tmp_path, dest)
-        saved.append(dest)
-    return saved
-
-def infer_process_and_checklist(doc_types: List[str]) -> Dict[str, Any]:
-    """
-    Determine which ADGM process the user is attempting based on uploaded doc types.
-    Very simple logic: if many incorporation docs, assume Company Incorporation.
-    """
-    matches = 0
-    for t in doc_types:
-        if t in CHECKLISTS.get("Company Incorporation", []):
-            matches += 1
-    # if at least two match, assume incorporation
-    if matches >= 2:
-        required = CHECKLISTS["Company Incorporation"]
-        missing = [d for d in required if d not in doc_types]
-        return {
-            "process": "Company Incorporation",
-            "documents_uploaded": len(doc_types),
-            "required_documents": len(required),
-            "missing_documents": missing
-        }
-    else:
-        return {
-            "process": "Unknown",
-            "documents_uploaded": len(doc_types),
-            "required_documents": None,
-            "missing_documents": []
-        }
-
-def analyze_documents(saved_paths: List[str], use_llm: bool=False):
-    summary = []
-    doc_types = []
-    all_annotations = {}  # filepath -> annotations
-    all_issues = []
-    for path in saved_paths:
-        paras = extract_structured_text(path)  # list of (idx, text)
-        combined_text = "\n".join([t for _, t in paras])
-        doc_type = detect_document_type(combined_text)
-        doc_types.append(doc_type)
-        issues = heuristic_checks(paras)
-        issues.extend(document_level_checks(paras))
-        # optional LLM review if rag_index available & use_llm True
-        if use_llm and rag_index is not None:
-            try:
-                issues_from_llm = llm_review(paras, rag_index, doc_name=doc_type)
-                issues.extend(issues_from_llm)
-            except Exception as e:
-                issues.append({
-                    "document": os.path.basename(path),
-                    "issue": "LLM review failed",
-                    "severity": "Low",
-                    "suggestion": str(e)
-                })
-        # prepare annotations for docx injection: use paragraph indices found in heuristic issues
-        annotations = []
-        for it in issues:
-            para_idx = it.get("document_index_paragraph") if it.get("document_index_paragraph") is not None else (it.get("document_paragraph_idx") if it.get("document_paragraph_idx") is not None else None)
-            if para_idx is None:
-                # attach to end of document
-                para_idx = len(paras)-1 if paras else 0
-            annotations.append({
-                "paragraph_index": para_idx,
-                "match_text": None,
-                "comment": f"{it.get('issue')}: {it.get('suggestion')}"
-            })
-        all_annotations[path] = annotations
-        all_issues.extend([{
-            "document": os.path.basename(path),
-            "doc_type": doc_type,
-            "section": it.get("section"),
-            "issue": it.get("issue"),
-            "severity": it.get("severity"),
-            "suggestion": it.get("suggestion")
-        } for it in issues])
-        summary.append({
-            "file": os.path.basename(path),
-            "type": doc_type,
-            "issues_found": len(issues)
-        })
-
-    # infer process
-    proc = infer_process_and_checklist(doc_types)
-    # create reviewed docx files
-    reviewed_files = []
-    for path, annotations in all_annotations.items():
-        outname = os.path.join(OUT_DIR, f"reviewed_{os.path.basename(path)}")
-        insert_comment_simulation(path, outname, annotations)
-        reviewed_files.append(outname)
-
-    result = {
-        "process": proc.get("process"),
-        "documents_uploaded": proc.get("documents_uploaded"),
-        "required_documents": proc.get("required_documents"),
-        "missing_documents": proc.get("missing_documents"),
-        "summary": summary,
-        "issues": all_issues,
-        "reviewed_files": reviewed_files
-    }
-    return result
-
-def handle_upload(*files, use_llm=False):
-    # files is a tuple from gradio (list of file objects)
-    # Save files
-    saved = process_uploaded_files(files)
-    result = analyze_documents(saved, use_llm=use_llm)
-    # Save JSON
-    json_path = os.path.join(OUT_DIR, f"analysis_{uuid.uuid4().hex}.json")
-    with open(json_path, "w", encoding="utf-8") as f:
-        json.dump(result, f, indent=2)
-    # return paths for download (reviewed zip maybe)
-    return result
-
-# Build Gradio app
-with gr.Blocks() as demo:
-    gr.Markdown("# ADGM Corporate Agent — Document Reviewer (MVP)")
-    with gr.Row():
-        with gr.Column():
-            uploaded = gr.File(label="Upload one or more .docx files", file_count="multiple", file_types=[".docx"])
-            use_llm = gr.Checkbox(label="Enable LLM-backed review (requires OPENAI_API_KEY set on server)", value=False)
-            run_btn = gr.Button("Analyze & Review")
-            output_json = gr.JSON()
-            reviewed_files_out = gr.File(label="Download reviewed .docx (one at a time)")
-        with gr.Column():
-            gr.Markdown("**Instructions**: Upload `.docx` files relevant to your ADGM process (e.g., Articles of Association, Incorporation Form). Optionally add ADGM reference `.txt` files to `adgm_refs/` and enable LLM review.")
-    def run_process(files, use_llm_flag):
-        if not files:
-            return {"error":"No files uploaded."}
-        try:
-            res = handle_upload(*files, use_llm=use_llm_flag)
-            # For simplicity return first reviewed file as downloadable
-            first_reviewed = res["reviewed_files"][0] if res["reviewed_files"] else None
-            out = {"result": res, "first_reviewed": first_reviewed}
-            return out
-        except Exception as e:
-            return {"error": str(e)}
-
-    run_btn.click(fn=run_process, inputs=[uploaded, use_llm], outputs=[output_json])
-
-if __name__ == "__main__":
-    demo.launch(share=False, server_name="0.0.0.0", server_port=7860)
+# app.py
+import os
+import re
+import uuid
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Dict, Any
+import gradio as gr
+from docx_utils import load_doc, paragraphs_of, insert_comment_simulation, sanitize_filename
+from rag import SimpleRAGIndex
+from checker import (CHECKER_VERSION, heuristic_checks, document_level_checks,
+                     llm_candidates, llm_review_with_context, scan_document,
+                     word_bounded_hits)
+import numpy as np
+from io import BytesIO
+from collections import Counter
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Load checklist
+import json as _json
+with open("checklist.json","r",encoding="utf-8") as f:
+    CHECKLISTS = _json.load(f)
+
+# configure reference folder for RAG
+REF_FOLDER = "adgm_refs"
+rag_index = None
+if os.path.exists(REF_FOLDER):
+    rag_index = SimpleRAGIndex()
+    rag_index.build_from_folder(REF_FOLDER)
+else:
+    rag_index = None
+    print("Warning: adgm_refs folder not found. RAG disabled until you add reference .txt files to adgm_refs/")
+
+OUT_DIR = "outputs"
+CACHE_DIR = "cache"
+os.makedirs(OUT_DIR, exist_ok=True)
+os.makedirs(CACHE_DIR, exist_ok=True)
+
+DOC_TYPE_KEYWORDS = {
+    "Articles of Association": ["articles of association", "articles", "aoa"],
+    "Memorandum of Association": ["memorandum of association", "memorandum", "moa", "mou"],
+    "Incorporation Application Form": ["incorporation application", "incorporation form"],
+    "UBO Declaration Form": ["ubo declaration", "ubo form"],
+    "Register of Members and Directors": ["register of members", "register of directors", "register of members and directors"]
+}
+
+DOC_TYPES = list(DOC_TYPE_KEYWORDS)
+
+# cached analyses store doc_type, which depends on this table, so its hash
+# joins CHECKER_VERSION in the cache key: editing the keywords invalidates
+_DOC_TYPE_KEYWORDS_HASH = hashlib.sha256(
+    json.dumps(DOC_TYPE_KEYWORDS, sort_keys=True).encode("utf-8")
+).hexdigest()[:12]
+
+def _build_doc_type_automaton():
+    """
+    Build an Aho-Corasick automaton over all doc-type keywords so a document
+    is scanned once, in O(len(text) + matches), instead of once per keyword.
+    Each keyword gets an integer id; _KW_TO_DOCTYPE maps id -> doc-type index.
+    Values carry the keyword length so matches can be boundary-checked.
+    """
+    if ahocorasick is None:
+        return None, None
+    A = ahocorasick.Automaton()
+    kw_doctypes = []
+    for dt_idx, (doc_type, kws) in enumerate(DOC_TYPE_KEYWORDS.items()):
+        for kw in kws:
+            A.add_word(kw.lower(), (len(kw_doctypes), len(kw)))
+            kw_doctypes.append(dt_idx)
+    A.make_automaton()
+    return A, np.asarray(kw_doctypes, dtype=np.int32)
+
+_DOC_TYPE_AUTOMATON, _KW_TO_DOCTYPE = _build_doc_type_automaton()
+
+def _score_hits(hit_ids, kw_to_doctype, n_doctypes):
+    counts = np.zeros(n_doctypes, np.int32)
+    for i in range(hit_ids.size):
+        counts[kw_to_doctype[hit_ids[i]]] += 1
+    return counts
+
+# JIT the counting loop when numba is available; compilation is cached
+# across runs, and the pure-Python version above is the fallback.
+if njit is not None:
+    _score_hits = njit(cache=True)(_score_hits)
+
+def detect_document_type(text: str) -> str:
+    txt = text.lower()
+    # count whole-word keyword hits per doc type and take the most frequent
+    if _DOC_TYPE_AUTOMATON is not None:
+        hit_ids = np.asarray(word_bounded_hits(_DOC_TYPE_AUTOMATON, txt), dtype=np.int32)
+        if hit_ids.size:
+            counts = _score_hits(hit_ids, _KW_TO_DOCTYPE, len(DOC_TYPES))
+            return DOC_TYPES[int(counts.argmax())]
+    else:
+        # pure-Python fallback when pyahocorasick is unavailable
+        counts = Counter()
+        for doc_type, kws in DOC_TYPE_KEYWORDS.items():
+            for kw in kws:
+                n = len(re.findall(rf"\b{re.escape(kw)}\b", txt))
+                if n:
+                    counts[doc_type] += n
+        if counts:
+            return counts.most_common(1)[0][0]
+    # fallback simple guesses
+    if "article" in txt and "association" in txt:
+        return "Articles of Association"
+    if "memorandum" in txt:
+        return "Memorandum of Association"
+    return "Unknown Document Type"
+
+def _doc_type_from_state(state, paras) -> str:
+    """
+    Classify from keyword hits already gathered by scan_document. Falls back
+    to the text-based path only when the automaton is unavailable or found
+    nothing (the rare case, so the join is only paid there).
+    """
+    if state.doc_type_hit_ids:
+        hit_ids = np.asarray(state.doc_type_hit_ids, dtype=np.int32)
+        counts = _score_hits(hit_ids, _KW_TO_DOCTYPE, len(DOC_TYPES))
+        return DOC_TYPES[int(counts.argmax())]
+    return detect_document_type("\n".join(t for _, t in paras))
+
+def process_uploaded_files(files):
+    """
+    files: list of (tempfile path, filename)
+    Returns list of (unique_name, bytes) read once from Gradio's tempfiles;
+    uploads are never copied to disk, the bytes feed python-docx directly.
+    """
+    saved = []
+    for f in files:
+        tmp_path = f.name if hasattr(f, "name") else f[0]
+        original_name = getattr(f, "filename", None) or (f[1] if isinstance(f, tuple) else os.path.basename(tmp_path))
+        base = sanitize_filename(original_name)
+        with open(tmp_path, "rb") as fh:
+            data = fh.read()
+        saved.append((f"{uuid.uuid4().hex}_{base}", data))
+    return saved
+
+def infer_process_and_checklist(doc_types: List[str]) -> Dict[str, Any]:
+    """
+    Determine which ADGM process the user is attempting based on uploaded doc types.
+    Very simple logic: if many incorporation docs, assume Company Incorporation.
+    """
+    matches = 0
+    for t in doc_types:
+        if t in CHECKLISTS.get("Company Incorporation", []):
+            matches += 1
+    # if at least two match, assume incorporation
+    if matches >= 2:
+        required = CHECKLISTS["Company Incorporation"]
+        missing = [d for d in required if d not in doc_types]
+        return {
+            "process": "Company Incorporation",
+            "documents_uploaded": len(doc_types),
+            "required_documents": len(required),
+            "missing_documents": missing
+        }
+    else:
+        return {
+            "process": "Unknown",
+            "documents_uploaded": len(doc_types),
+            "required_documents": None,
+            "missing_documents": []
+        }
+
+def _process_one(item: Tuple[str, bytes]):
+    """
+    Analyze a single uploaded file: parse, classify, run heuristic checks.
+    item is (unique_name, docx bytes); LLM review is done in a second,
+    globally-batched pass by the caller.
+    Returns (name, doc, doc_type, paras, issues).
+
+    Heuristic results are cached on disk keyed by the file's content hash
+    (and CHECKER_VERSION, so rule changes invalidate old entries); users
+    re-uploading the same document skip classification and checks.
+    """
+    name, data = item
+    h = hashlib.sha256(data).hexdigest()
+    cache_file = os.path.join(
+        CACHE_DIR, f"analysis_{h}_v{CHECKER_VERSION}_{_DOC_TYPE_KEYWORDS_HASH}.json")
+    doc = load_doc(BytesIO(data))  # parsed once, reused for annotation
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+            paras = [(i, t) for i, t in cached["paras"]]
+            return name, doc, cached["doc_type"], paras, cached["issues"]
+        except Exception:
+            pass  # corrupt/stale entry: fall through and recompute
+    paras = paragraphs_of(doc)  # list of (idx, text)
+    # one pass over the paragraphs covers doc-type keywords and the
+    # document-level signature/jurisdiction flags, with no joined copy
+    state = scan_document(paras, _DOC_TYPE_AUTOMATON)
+    doc_type = _doc_type_from_state(state, paras)
+    issues = heuristic_checks(paras)
+    issues.extend(document_level_checks(paras, state=state))
+    with open(cache_file, "w", encoding="utf-8") as f:
+        json.dump({"doc_type": doc_type, "paras": paras, "issues": issues}, f)
+    return name, doc, doc_type, paras, issues
+
+def _llm_review_all(results, use_llm: bool):
+    """
+    Second pass over all files: gather suspect paragraphs across every
+    document, retrieve RAG context with one batched encode + one FAISS
+    search, then scatter the contexts back to per-file LLM review.
+    """
+    if not (use_llm and rag_index is not None):
+        return
+    per_file_cands = [llm_candidates(paras) for _, _, _, paras, _ in results]
+    all_texts = [t for cands in per_file_cands for _, t in cands]
+    if not all_texts:
+        return
+    try:
+        retrieved_all = rag_index.retrieve_batch(all_texts, k=3)
+    except Exception as e:
+        for name, _, _, _, issues in results:
+            issues.append({
+                "document": name,
+                "issue": "LLM review failed",
+                "severity": "Low",
+                "suggestion": str(e)
+            })
+        return
+    offset = 0
+    for (name, doc, doc_type, paras, issues), cands in zip(results, per_file_cands):
+        retrieved = retrieved_all[offset:offset + len(cands)]
+        offset += len(cands)
+        if not cands:
+            continue
+        try:
+            issues.extend(llm_review_with_context(cands, retrieved, doc_name=doc_type))
+        except Exception as e:
+            issues.append({
+                "document": name,
+                "issue": "LLM review failed",
+                "severity": "Low",
+                "suggestion": str(e)
+            })
+
+def analyze_documents(saved: List[Tuple[str, bytes]], use_llm: bool=False):
+    summary = []
+    doc_types = []
+    all_annotations = {}  # unique name -> (doc, annotations)
+    all_issues = []
+    # files are independent and dominated by I/O (docx unzip/XML parse),
+    # so process them in a thread pool
+    with ThreadPoolExecutor(max_workers=min(8, max(1, len(saved)))) as pool:
+        results = list(pool.map(_process_one, saved))
+    # one batched RAG retrieval across all files, then per-file LLM review
+    _llm_review_all(results, use_llm)
+    for name, doc, doc_type, paras, issues in results:
+        doc_types.append(doc_type)
+        # prepare annotations for docx injection: use paragraph indices found in heuristic issues
+        annotations = []
+        for it in issues:
+            para_idx = it.get("document_index_paragraph") if it.get("document_index_paragraph") is not None else (it.get("document_paragraph_idx") if it.get("document_paragraph_idx") is not None else None)
+            if para_idx is None:
+                # attach to end of document
+                para_idx = len(paras)-1 if paras else 0
+            annotations.append({
+                "paragraph_index": para_idx,
+                "match_text": None,
+                "comment": f"{it.get('issue')}: {it.get('suggestion')}"
+            })
+        all_annotations[name] = (doc, annotations)
+        all_issues.extend([{
+            "document": name,
+            "doc_type": doc_type,
+            "section": it.get("section"),
+            "issue": it.get("issue"),
+            "severity": it.get("severity"),
+            "suggestion": it.get("suggestion")
+        } for it in issues])
+        summary.append({
+            "file": name,
+            "type": doc_type,
+            "issues_found": len(issues)
+        })
+
+    # infer process
+    proc = infer_process_and_checklist(doc_types)
+    # create reviewed docx files
+    reviewed_files = []
+    for name, (doc, annotations) in all_annotations.items():
+        outname = os.path.join(OUT_DIR, f"reviewed_{name}")
+        blob = insert_comment_simulation(doc, annotations)
+        with open(outname, "wb") as f:
+            f.write(blob)
+        reviewed_files.append(outname)
+
+    result = {
+        "process": proc.get("process"),
+        "documents_uploaded": proc.get("documents_uploaded"),
+        "required_documents": proc.get("required_documents"),
+        "missing_documents": proc.get("missing_documents"),
+        "summary": summary,
+        "issues": all_issues,
+        "reviewed_files": reviewed_files
+    }
+    return result
+
+def handle_upload(*files, use_llm=False):
+    # files is a tuple from gradio (list of file objects)
+    # Save files
+    saved = process_uploaded_files(files)
+    result = analyze_documents(saved, use_llm=use_llm)
+    # Save JSON
+    json_path = os.path.join(OUT_DIR, f"analysis_{uuid.uuid4().hex}.json")
+    with open(json_path, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+    # return paths for download (reviewed zip maybe)
+    return result
+
+# Build Gradio app
+with gr.Blocks() as demo:
+    gr.Markdown("# ADGM Corporate Agent — Document Reviewer (MVP)")
+    with gr.Row():
+        with gr.Column():
+            uploaded = gr.File(label="Upload one or more .docx files", file_count="multiple", file_types=[".docx"])
+            use_llm = gr.Checkbox(label="Enable LLM-backed review (requires OPENAI_API_KEY set on server)", value=False)
+            run_btn = gr.Button("Analyze & Review")
+            output_json = gr.JSON()
+            reviewed_files_out = gr.File(label="Download reviewed .docx (one at a time)")
+        with gr.Column():
+            gr.Markdown("**Instructions**: Upload `.docx` files relevant to your ADGM process (e.g., Articles of Association, Incorporation Form). Optionally add ADGM reference `.txt` files to `adgm_refs/` and enable LLM review.")
+    def run_process(files, use_llm_flag):
+        if not files:
+            return {"error":"No files uploaded."}
+        try:
+            res = handle_upload(*files, use_llm=use_llm_flag)
+            # For simplicity return first reviewed file as downloadable
+            first_reviewed = res["reviewed_files"][0] if res["reviewed_files"] else None
+            out = {"result": res, "first_reviewed": first_reviewed}
+            return out
+        except Exception as e:
+            return {"error": str(e)}
+
+    run_btn.click(fn=run_process, inputs=[uploaded, use_llm], outputs=[output_json])
+
+if __name__ == "__main__":
+    demo.launch(share=False, server_name="0.0.0.0", server_port=7860)
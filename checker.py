@@ -1,152 +1,376 @@
-# checker.py
-import re
-from typing import List, Dict, Any, Tuple
-from rag import SimpleRAGIndex
-import os
-import openai
-import json
-OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
-
-AMBIGUOUS_TERMS = [
-    r"\bmay\b",
-    r"\bpossible\b",
-    r"\bsubject to\b",
-    r"\bas appropriate\b",
-    r"\bwhere practicable\b"
-]
-
-JURISDICTION_PATTERNS = [
-    r"ADGM",
-    r"Abu Dhabi Global Market",
-    r"ADGM Courts",
-    r"\bAbu Dhabi\b"
-]
-
-FEDERAL_COURTS_PATTERNS = [
-    r"UAE Federal Courts",
-    r"Federal Courts of the UAE",
-    r"\bUAE Courts\b"
-]
-
-SIGNATURE_PATTERNS = [
-    r"Signature:",
-    r"Signed by",
-    r"Signatory",
-    r"Signature\s+of"
-]
-
-def heuristic_checks(paragraphs: List[Tuple[int, str]]) -> List[Dict[str, Any]]:
-    """
-    paragraphs: list of (index, text)
-    """
-    issues = []
-    # check for jurisdiction mismatch
-    for idx, text in paragraphs:
-        if re.search("|".join(FEDERAL_COURTS_PATTERNS), text, re.IGNORECASE):
-            issues.append({
-                "document_index_paragraph": idx,
-                "issue": "References UAE Federal Courts instead of ADGM",
-                "section": f"Paragraph {idx}",
-                "severity": "High",
-                "suggestion": "Replace references to UAE Federal Courts with ADGM Courts (per ADGM Companies Regulations)."
-            })
-        # ambiguous language
-        for pattern in AMBIGUOUS_TERMS:
-            if re.search(pattern, text, re.IGNORECASE):
-                issues.append({
-                    "document_index_paragraph": idx,
-                    "issue": f"Ambiguous language: contains '{pattern.strip('\\b')}'",
-                    "section": f"Paragraph {idx}",
-                    "severity": "Medium",
-                    "suggestion": "Consider clarifying to explicit obligation or remove discretionary terms."
-                })
-        # missing signature detection (if a doc has no mention of signature sections)
-    # signature checks at document-level (handled elsewhere)
-    return issues
-
-def document_level_checks(paragraphs: List[Tuple[int, str]]) -> List[Dict[str, Any]]:
-    issues = []
-    combined_text = "\n".join([t for _, t in paragraphs])
-    if not re.search("|".join(SIGNATURE_PATTERNS), combined_text, re.IGNORECASE):
-        issues.append({
-            "document_index_paragraph": None,
-            "issue": "No signatory or signature block detected",
-            "section": "End of document",
-            "severity": "High",
-            "suggestion": "Add a clearly labelled signature block for authorized signatories with name, title and date."
-        })
-    # Jurisdiction absence: flag if no ADGM reference
-    if not re.search("|".join(JURISDICTION_PATTERNS), combined_text, re.IGNORECASE):
-        issues.append({
-            "document_index_paragraph": None,
-            "issue": "Jurisdiction not specified as ADGM",
-            "section": "Governing Law / Jurisdiction clause",
-            "severity": "High",
-            "suggestion": "Set governing law and jurisdiction to ADGM and ADGM Courts."
-        })
-    return issues
-
-def call_llm(prompt: str, model="gpt-4o-mini", max_tokens=512) -> str:
-    """
-    Simple wrapper for OpenAI. If no key, raises.
-    """
-    if not OPENAI_API_KEY:
-        raise RuntimeError("OPENAI_API_KEY not set; LLM call unavailable.")
-    openai.api_key = OPENAI_API_KEY
-    resp = openai.ChatCompletion.create(
-        model="gpt-4o-mini",
-        messages=[{"role": "user", "content": prompt}],
-        max_tokens=max_tokens,
-        temperature=0.0
-    )
-    # extract content
-    return resp["choices"][0]["message"]["content"].strip()
-
-def llm_review(paragraphs: List[Tuple[int, str]], rag_index: SimpleRAGIndex, doc_name="Document") -> List[Dict[str, Any]]:
-    """
-    For each suspicious paragraph we send a small prompt with RAG context and ask for compliance checks.
-    """
-    issues = []
-    for idx, text in paragraphs:
-        # heuristic quick filter: only send paragraphs containing ambiguous/jurisdiction/sig patterns
-        if re.search("|".join(AMBIGUOUS_TERMS + FEDERAL_COURTS_PATTERNS + SIGNATURE_PATTERNS), text, re.IGNORECASE):
-            retrieved = rag_index.retrieve(text, k=3)
-            context = "\n\n".join([r[0] for r in retrieved])
-            prompt = f"""You are a legal assistant specialized in Abu Dhabi Global Market (ADGM) company regulations.
-Review the following paragraph from a {doc_name}:
----PARAGRAPH---
-{text}
----END PARAGRAPH---
-
-Here are relevant ADGM references retrieved:
-{context}
-
-Please:
-1) Identify whether this paragraph violates ADGM practice or contains red flags (jurisdiction, missing clause, ambiguous language).
-2) If an issue found, produce a short suggestion and cite the reference using the format [source: filename]. 
-3) Return JSON list of objects with keys: paragraph_index, issue, severity, suggestion.
-"""
-            try:
-                out = call_llm(prompt)
-                # Attempt to parse as JSON; else store as raw
-                import json
-                try:
-                    parsed = json.loads(out)
-                    for p in parsed:
-                        p["document_paragraph_idx"] = idx
-                    issues.extend(parsed)
-                except Exception:
-                    issues.append({
-                        "document_paragraph_idx": idx,
-                        "issue": "LLM review returned non-JSON output",
-                        "severity": "Low",
-                        "suggestion": out[:400]
-                    })
-            except Exception as e:
-                issues.append({
-                    "document_paragraph_idx": idx,
-                    "issue": "LLM call failed",
-                    "severity": "Low",
-                    "suggestion": str(e)
-                })
-    return issues
+# checker.py
+import re
+import asyncio
+from typing import List, Dict, Any, Tuple
+from rag import SimpleRAGIndex
+import os
+import openai
+import json
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+
+# bump when the heuristic rules below change, to invalidate cached analyses
+CHECKER_VERSION = 1
+
+AMBIGUOUS_TERMS = [
+    r"\bmay\b",
+    r"\bpossible\b",
+    r"\bsubject to\b",
+    r"\bas appropriate\b",
+    r"\bwhere practicable\b"
+]
+
+JURISDICTION_PATTERNS = [
+    r"ADGM",
+    r"Abu Dhabi Global Market",
+    r"ADGM Courts",
+    r"\bAbu Dhabi\b"
+]
+
+FEDERAL_COURTS_PATTERNS = [
+    r"UAE Federal Courts",
+    r"Federal Courts of the UAE",
+    r"\bUAE Courts\b"
+]
+
+SIGNATURE_PATTERNS = [
+    r"Signature:",
+    r"Signed by",
+    r"Signatory",
+    r"Signature\s+of"
+]
+
+def _compile_union(patterns: List[str]) -> re.Pattern:
+    """
+    Union a list of patterns into one compiled regex with named groups
+    (t0, t1, ...) so a match can be traced back to the original term.
+    """
+    return re.compile("|".join(f"(?P<t{i}>{p})" for i, p in enumerate(patterns)), re.IGNORECASE)
+
+# Precompiled at import so the hot paths scan each paragraph once
+# instead of joining+searching per term per call.
+AMBIGUOUS_RE = _compile_union(AMBIGUOUS_TERMS)
+JURISDICTION_RE = _compile_union(JURISDICTION_PATTERNS)
+FEDERAL_RE = _compile_union(FEDERAL_COURTS_PATTERNS)
+SIGNATURE_RE = _compile_union(SIGNATURE_PATTERNS)
+
+# map group name back to a readable term for issue messages
+AMBIGUOUS_TERM_BY_GROUP = {f"t{i}": p.strip("\\b") for i, p in enumerate(AMBIGUOUS_TERMS)}
+
+def _build_prefilter_automaton():
+    """
+    Aho-Corasick automaton over the literal forms of all suspect terms,
+    used as a cheap single-pass prefilter before LLM review. The scanned
+    text has its whitespace collapsed to single spaces first, so \\s+
+    patterns reduce to their single-space literals; substring matching then
+    over-matches relative to the word-boundary regexes (e.g. 'may' inside
+    'maybe'), which only costs an extra LLM look, never a missed one.
+    """
+    if ahocorasick is None:
+        return None
+    A = ahocorasick.Automaton()
+    for p in AMBIGUOUS_TERMS + FEDERAL_COURTS_PATTERNS + SIGNATURE_PATTERNS:
+        literal = p.strip("\\b").replace(r"\s+", " ").lower()
+        A.add_word(literal, literal)
+    A.make_automaton()
+    return A
+
+_PREFILTER_AUTOMATON = _build_prefilter_automaton()
+
+def _has_suspect_terms(text: str) -> bool:
+    if _PREFILTER_AUTOMATON is not None:
+        # collapse whitespace runs so terms derived from \s+ patterns match
+        collapsed = " ".join(text.split()).lower()
+        return next(_PREFILTER_AUTOMATON.iter(collapsed), None) is not None
+    return bool(AMBIGUOUS_RE.search(text) or FEDERAL_RE.search(text) or SIGNATURE_RE.search(text))
+
+def word_bounded_hits(automaton, txt: str) -> List[int]:
+    """
+    Keyword ids for automaton matches whose values are (kw_id, len(kw)),
+    keeping only matches flanked by non-word characters so e.g. 'mou' does
+    not fire inside 'amount'.
+    """
+    hits = []
+    n = len(txt)
+    for end, (kw_id, klen) in automaton.iter(txt):
+        start = end - klen + 1
+        if start > 0 and (txt[start - 1].isalnum() or txt[start - 1] == "_"):
+            continue
+        if end + 1 < n and (txt[end + 1].isalnum() or txt[end + 1] == "_"):
+            continue
+        hits.append(kw_id)
+    return hits
+
+class ScanState:
+    """
+    Results of one pass over a document's paragraphs: document-level flags
+    plus doc-type keyword hits, so downstream checks become O(1) lookups
+    instead of re-scanning a joined copy of the full text.
+    """
+    def __init__(self):
+        self.saw_signature = False
+        self.saw_jurisdiction = False
+        self.doc_type_hit_ids = None  # list of keyword ids, when an automaton is given
+
+def scan_document(paragraphs: List[Tuple[int, str]], doc_type_automaton=None) -> ScanState:
+    """
+    Single pass over paragraphs feeding the precompiled document-level
+    regexes (short-circuited once seen) and, when provided, the doc-type
+    keyword automaton.
+    """
+    state = ScanState()
+    if doc_type_automaton is not None:
+        state.doc_type_hit_ids = []
+    for _, text in paragraphs:
+        if not state.saw_signature and SIGNATURE_RE.search(text):
+            state.saw_signature = True
+        if not state.saw_jurisdiction and JURISDICTION_RE.search(text):
+            state.saw_jurisdiction = True
+        if doc_type_automaton is not None:
+            state.doc_type_hit_ids.extend(word_bounded_hits(doc_type_automaton, text.lower()))
+    return state
+
+def heuristic_checks(paragraphs: List[Tuple[int, str]]) -> List[Dict[str, Any]]:
+    """
+    paragraphs: list of (index, text)
+    """
+    issues = []
+    # check for jurisdiction mismatch
+    for idx, text in paragraphs:
+        if FEDERAL_RE.search(text):
+            issues.append({
+                "document_index_paragraph": idx,
+                "issue": "References UAE Federal Courts instead of ADGM",
+                "section": f"Paragraph {idx}",
+                "severity": "High",
+                "suggestion": "Replace references to UAE Federal Courts with ADGM Courts (per ADGM Companies Regulations)."
+            })
+        # ambiguous language: one pass over the paragraph for all terms,
+        # one issue per unique term no matter how often it repeats
+        seen_terms = set()
+        for m in AMBIGUOUS_RE.finditer(text):
+            term = AMBIGUOUS_TERM_BY_GROUP[m.lastgroup]
+            if term in seen_terms:
+                continue
+            seen_terms.add(term)
+            issues.append({
+                "document_index_paragraph": idx,
+                "issue": f"Ambiguous language: contains '{term}'",
+                "section": f"Paragraph {idx}",
+                "severity": "Medium",
+                "suggestion": "Consider clarifying to explicit obligation or remove discretionary terms."
+            })
+        # missing signature detection (if a doc has no mention of signature sections)
+    # signature checks at document-level (handled elsewhere)
+    return issues
+
+def document_level_checks(paragraphs: List[Tuple[int, str]], state: ScanState = None) -> List[Dict[str, Any]]:
+    issues = []
+    if state is None:
+        state = scan_document(paragraphs)
+    if not state.saw_signature:
+        issues.append({
+            "document_index_paragraph": None,
+            "issue": "No signatory or signature block detected",
+            "section": "End of document",
+            "severity": "High",
+            "suggestion": "Add a clearly labelled signature block for authorized signatories with name, title and date."
+        })
+    # Jurisdiction absence: flag if no ADGM reference
+    if not state.saw_jurisdiction:
+        issues.append({
+            "document_index_paragraph": None,
+            "issue": "Jurisdiction not specified as ADGM",
+            "section": "Governing Law / Jurisdiction clause",
+            "severity": "High",
+            "suggestion": "Set governing law and jurisdiction to ADGM and ADGM Courts."
+        })
+    return issues
+
+# one client instance per process, created on first use
+_CLIENT = None
+
+def _get_client():
+    global _CLIENT
+    if _CLIENT is None:
+        if not OPENAI_API_KEY:
+            raise RuntimeError("OPENAI_API_KEY not set; LLM call unavailable.")
+        _CLIENT = openai.OpenAI(api_key=OPENAI_API_KEY)
+    return _CLIENT
+
+def call_llm(prompt: str, model="gpt-4o-mini", max_tokens=512) -> str:
+    """
+    Simple wrapper for OpenAI. If no key, raises.
+    """
+    resp = _get_client().chat.completions.create(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        max_tokens=max_tokens,
+        temperature=0.0
+    )
+    # extract content
+    return resp.choices[0].message.content.strip()
+
+# cap concurrent in-flight OpenAI requests
+LLM_MAX_CONCURRENCY = 8
+
+# pack several suspect paragraphs into one prompt, up to this many
+# paragraphs / this many combined paragraph tokens per request
+LLM_BATCH_MAX_PARAGRAPHS = 8
+LLM_BATCH_TOKEN_BUDGET = 3000
+
+try:
+    import tiktoken
+    _TIKTOKEN_ENC = tiktoken.encoding_for_model("gpt-4o-mini")
+except Exception:
+    _TIKTOKEN_ENC = None
+
+def _count_tokens(text: str) -> int:
+    if _TIKTOKEN_ENC is not None:
+        return len(_TIKTOKEN_ENC.encode(text))
+    # rough heuristic when tiktoken is unavailable: ~4 chars per token
+    return max(1, len(text) // 4)
+
+async def acall_llm(client, prompt: str, model="gpt-4o-mini", max_tokens=512) -> str:
+    resp = await client.chat.completions.create(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        max_tokens=max_tokens,
+        temperature=0.0
+    )
+    return resp.choices[0].message.content.strip()
+
+async def _acall_llm_all(prompts: List[str], max_tokens_each: List[int] = None) -> List[Any]:
+    """
+    Fire all prompts concurrently, bounded by a semaphore. Returns one
+    entry per prompt, either the response text or the exception raised.
+    max_tokens_each optionally gives a per-prompt completion cap.
+    """
+    if not OPENAI_API_KEY:
+        raise RuntimeError("OPENAI_API_KEY not set; LLM call unavailable.")
+    if max_tokens_each is None:
+        max_tokens_each = [512] * len(prompts)
+    # per-batch client: each asyncio.run uses a fresh event loop, and the
+    # underlying httpx client binds to the loop it first runs on
+    client = openai.AsyncOpenAI(api_key=OPENAI_API_KEY)
+    sem = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+
+    async def bounded(prompt, max_tokens):
+        async with sem:
+            return await acall_llm(client, prompt, max_tokens=max_tokens)
+
+    try:
+        return await asyncio.gather(
+            *[bounded(p, mt) for p, mt in zip(prompts, max_tokens_each)],
+            return_exceptions=True)
+    finally:
+        await client.close()
+
+def llm_candidates(paragraphs: List[Tuple[int, str]]) -> List[Tuple[int, str]]:
+    """
+    Heuristic quick filter: only paragraphs containing ambiguous/jurisdiction/sig
+    patterns are worth an LLM call.
+    """
+    return [(idx, text) for idx, text in paragraphs if _has_suspect_terms(text)]
+
+def llm_review(paragraphs: List[Tuple[int, str]], rag_index: SimpleRAGIndex, doc_name="Document") -> List[Dict[str, Any]]:
+    """
+    For each suspicious paragraph we send a small prompt with RAG context and ask for compliance checks.
+    """
+    candidates = llm_candidates(paragraphs)
+    if not candidates:
+        return []
+    # one batched encode + one FAISS search for all suspect paragraphs
+    retrieved_all = rag_index.retrieve_batch([t for _, t in candidates], k=3)
+    return llm_review_with_context(candidates, retrieved_all, doc_name=doc_name)
+
+def llm_review_with_context(candidates: List[Tuple[int, str]],
+                            retrieved_all: List[List[Tuple[str, float]]],
+                            doc_name="Document") -> List[Dict[str, Any]]:
+    """
+    Build prompts and call the LLM for candidate paragraphs whose RAG context
+    has already been retrieved (possibly batched across several documents).
+    Short paragraphs are packed several-per-prompt (bounded by a token
+    budget), and the resulting prompts are issued concurrently, so both the
+    number of round-trips and the wall time per round-trip batch shrink.
+    """
+    issues = []
+    # bucket candidates so one request reviews several paragraphs at once
+    buckets = []  # list of (candidate sublist, retrieved sublist)
+    cur, cur_ret, cur_tokens = [], [], 0
+    for cand, retrieved in zip(candidates, retrieved_all):
+        t = _count_tokens(cand[1])
+        if cur and (cur_tokens + t > LLM_BATCH_TOKEN_BUDGET or len(cur) >= LLM_BATCH_MAX_PARAGRAPHS):
+            buckets.append((cur, cur_ret))
+            cur, cur_ret, cur_tokens = [], [], 0
+        cur.append(cand)
+        cur_ret.append(retrieved)
+        cur_tokens += t
+    if cur:
+        buckets.append((cur, cur_ret))
+
+    prompts = []
+    for cands, rets in buckets:
+        # union of retrieved references across the bucket, deduped in order
+        seen = set()
+        context_parts = []
+        for retrieved in rets:
+            for ref, _score in retrieved:
+                if ref not in seen:
+                    seen.add(ref)
+                    context_parts.append(ref)
+        context = "\n\n".join(context_parts)
+        para_block = "\n\n".join(f"(id={idx}) {text}" for idx, text in cands)
+        prompt = f"""You are a legal assistant specialized in Abu Dhabi Global Market (ADGM) company regulations.
+Review the following paragraphs from a {doc_name}:
+---PARAGRAPHS---
+{para_block}
+---END PARAGRAPHS---
+
+Here are relevant ADGM references retrieved:
+{context}
+
+Please:
+1) For each paragraph, identify whether it violates ADGM practice or contains red flags (jurisdiction, missing clause, ambiguous language).
+2) If an issue found, produce a short suggestion and cite the reference using the format [source: filename]. 
+3) Return a JSON list of objects with keys: id (the paragraph id given above), issue, severity, suggestion. Only include paragraphs with issues.
+"""
+        prompts.append(prompt)
+    # keep the baseline's 512-token completion budget per paragraph, not per
+    # request, so packed buckets don't truncate into unparseable JSON
+    max_tokens_each = [512 * len(cands) for cands, _rets in buckets]
+    outputs = asyncio.run(_acall_llm_all(prompts, max_tokens_each))
+    for (cands, _rets), out in zip(buckets, outputs):
+        valid_ids = {idx for idx, _ in cands}
+        first_idx = cands[0][0]
+        if isinstance(out, Exception):
+            issues.append({
+                "document_paragraph_idx": first_idx,
+                "issue": "LLM call failed",
+                "severity": "Low",
+                "suggestion": str(out)
+            })
+            continue
+        # Attempt to parse as JSON; else store as raw
+        try:
+            parsed = json.loads(out)
+            for p in parsed:
+                pid = p.pop("id", None)
+                try:
+                    pid = int(pid)  # models often emit ids as strings
+                except (TypeError, ValueError):
+                    pid = None
+                p["document_paragraph_idx"] = pid if pid in valid_ids else first_idx
+                issues.append(p)
+        except Exception:
+            issues.append({
+                "document_paragraph_idx": first_idx,
+                "issue": "LLM review returned non-JSON output",
+                "severity": "Low",
+                "suggestion": out[:400]
+            })
+    return issues
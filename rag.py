@@ -1,55 +1,221 @@
-# rag.py
-import os
-from sentence_transformers import SentenceTransformer
-import numpy as np
-import faiss
-from typing import List, Tuple
-from tqdm import tqdm
-
-MODEL_NAME = "all-MiniLM-L6-v2"
-
-class SimpleRAGIndex:
-    def __init__(self, model_name=MODEL_NAME, index_path=None):
-        self.model = SentenceTransformer(model_name)
-        self.index = None
-        self.embeddings = None
-        self.texts = []
-        self.index_path = index_path
-
-    def build_from_folder(self, folder_path: str):
-        """
-        Reads all .txt files from folder, splits into chunks (here by paragraph lines),
-        builds embeddings and a FAISS index.
-        """
-        texts = []
-        for fname in os.listdir(folder_path):
-            if not fname.lower().endswith(".txt"):
-                continue
-            p = os.path.join(folder_path, fname)
-            with open(p, "r", encoding="utf-8") as f:
-                raw = f.read()
-            # split by double-newline or single newline
-            chunks = [chunk.strip() for chunk in raw.split("\n\n") if chunk.strip()]
-            # prefix with filename for traceability
-            for c in chunks:
-                texts.append(f"[{fname}] {c}")
-        if not texts:
-            raise ValueError("No reference text files found in folder.")
-        self.texts = texts
-        embs = self.model.encode(texts, show_progress_bar=True, convert_to_numpy=True)
-        self.embeddings = embs.astype("float32")
-        dim = self.embeddings.shape[1]
-        self.index = faiss.IndexFlatL2(dim)
-        self.index.add(self.embeddings)
-        if self.index_path:
-            faiss.write_index(self.index, self.index_path)
-
-    def retrieve(self, query: str, k=4) -> List[Tuple[str, float]]:
-        q_emb = self.model.encode([query], convert_to_numpy=True).astype("float32")
-        D, I = self.index.search(q_emb, k)
-        out = []
-        for i, dist in zip(I[0], D[0]):
-            if i < 0 or i >= len(self.texts):
-                continue
-            out.append((self.texts[i], float(dist)))
-        return out
+# rag.py
+import os
+import json
+import hashlib
+from sentence_transformers import SentenceTransformer
+import numpy as np
+import faiss
+from typing import List, Tuple
+from tqdm import tqdm
+
+MODEL_NAME = "all-MiniLM-L6-v2"
+CACHE_DIR = "cache"
+# sliding-window chunking: 256-token windows with 32 tokens of overlap
+CHUNK_TOKENS = 256
+CHUNK_STRIDE = 224
+# int8 ONNX export of the same model, produced offline with:
+#   optimum-cli export onnx --model sentence-transformers/all-MiniLM-L6-v2 onnx_model/
+# followed by optimum.onnxruntime.ORTQuantizer dynamic int8 quantization.
+ONNX_MODEL_DIR = "onnx_model"
+
+class ONNXEncoder:
+    """
+    Drop-in replacement for SentenceTransformer.encode backed by an int8
+    ONNX export. Mean-pools the last hidden state over the attention mask
+    and L2-normalizes, matching SentenceTransformer output, at roughly
+    2-3x CPU throughput thanks to int8 kernels.
+    """
+    def __init__(self, model_dir: str):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        quantized = os.path.join(model_dir, "model_quantized.onnx")
+        model_path = quantized if os.path.exists(quantized) else os.path.join(model_dir, "model.onnx")
+        self.model_path = model_path  # identifies this encoder in cache keys
+        self.session = ort.InferenceSession(model_path, providers=["CPUExecutionProvider"])
+        self._input_names = {i.name for i in self.session.get_inputs()}
+
+    def encode(self, texts, batch_size=64, convert_to_numpy=True, show_progress_bar=False):
+        out = []
+        for i in range(0, len(texts), batch_size):
+            enc = self.tokenizer(texts[i:i + batch_size], padding=True, truncation=True,
+                                 max_length=256, return_tensors="np")
+            inputs = {k: v for k, v in enc.items() if k in self._input_names}
+            hidden = self.session.run(None, inputs)[0]  # (batch, tokens, dim)
+            mask = enc["attention_mask"][..., None].astype(np.float32)
+            emb = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            emb /= np.clip(np.linalg.norm(emb, axis=1, keepdims=True), 1e-12, None)
+            out.append(emb.astype("float32"))
+        return np.concatenate(out)
+
+def _make_encoder(model_name: str):
+    if os.path.isdir(ONNX_MODEL_DIR):
+        try:
+            return ONNXEncoder(ONNX_MODEL_DIR)
+        except Exception as e:
+            print(f"Warning: ONNX encoder unavailable ({e}); falling back to SentenceTransformer.")
+    return SentenceTransformer(model_name)
+
+_MODELS = {}
+
+def get_model(model_name: str = MODEL_NAME):
+    """
+    Process-wide encoder cache, keyed by model name: each model (hundreds
+    of MB, ~1s cold load) is created once and shared by every
+    SimpleRAGIndex requesting it instead of being reloaded per instance.
+    """
+    if model_name not in _MODELS:
+        _MODELS[model_name] = _make_encoder(model_name)
+    return _MODELS[model_name]
+
+class SimpleRAGIndex:
+    def __init__(self, model_name=MODEL_NAME, index_path=None):
+        self.model_name = model_name
+        self.model = get_model(model_name)
+        self.index = None
+        self.embeddings = None
+        self.texts = []
+        self.index_path = index_path
+
+    def build_from_folder(self, folder_path: str, cache_dir: str = CACHE_DIR):
+        """
+        Reads all .txt files from folder, splits each into overlapping
+        fixed-size token windows (see CHUNK_TOKENS/CHUNK_STRIDE), builds
+        embeddings and a FAISS index.
+
+        Embeddings are cached on disk per source file, keyed by content hash,
+        so unchanged files skip encoding entirely on subsequent starts. When
+        no reference file changed at all, the previously built FAISS index is
+        memory-mapped straight back in and the build is skipped outright.
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        raws = {}
+        manifest = {}
+        for fname in sorted(os.listdir(folder_path)):
+            if not fname.lower().endswith(".txt"):
+                continue
+            p = os.path.join(folder_path, fname)
+            with open(p, "r", encoding="utf-8") as f:
+                raw = f.read()
+            raws[fname] = raw
+            # encoder identity and chunking params are part of the key so
+            # cached embeddings and the persisted index invalidate when the
+            # model (e.g. an onnx_model/ export appearing) or windowing changes
+            manifest[fname] = hashlib.sha256(
+                f"{self._encoder_id()}|{CHUNK_TOKENS}:{CHUNK_STRIDE}:".encode("utf-8")
+                + raw.encode("utf-8")
+            ).hexdigest()
+        index_file = os.path.join(cache_dir, "faiss.index")
+        texts_file = os.path.join(cache_dir, "texts.json")
+        manifest_file = os.path.join(cache_dir, "manifest.json")
+        if self._load_cached_index(index_file, texts_file, manifest_file, manifest):
+            return
+        texts = []
+        emb_blocks = []
+        for fname, raw in raws.items():
+            h = manifest[fname]
+            cache_file = os.path.join(cache_dir, f"{h}.npz")
+            if os.path.exists(cache_file):
+                cached = np.load(cache_file, allow_pickle=True)
+                chunks = list(cached["chunks"])
+                embs = cached["embs"]
+            else:
+                # fixed-size token windows with overlap: uniform chunk sizes
+                # batch through the encoder with little padding waste and
+                # retrieve better than blank-line splits of wildly varying size
+                chunks = self._chunk_text(raw, fname)
+                if not chunks:
+                    continue
+                embs = self.model.encode(chunks, batch_size=64, show_progress_bar=True,
+                                         convert_to_numpy=True).astype("float32")
+                np.savez(cache_file, embs=embs, chunks=np.array(chunks, dtype=object))
+            texts.extend(chunks)
+            emb_blocks.append(embs)
+        if not texts:
+            raise ValueError("No reference text files found in folder.")
+        self.texts = texts
+        self.embeddings = np.concatenate(emb_blocks).astype("float32")
+        # L2-normalize so inner product == cosine similarity, then use an
+        # HNSW graph index: log-scale search instead of a flat O(N) scan.
+        faiss.normalize_L2(self.embeddings)
+        dim = self.embeddings.shape[1]
+        self.index = faiss.IndexHNSWFlat(dim, 32, faiss.METRIC_INNER_PRODUCT)
+        self.index.hnsw.efConstruction = 80
+        self.index.add(self.embeddings)
+        # persist index + texts + manifest so the next start can mmap it back
+        faiss.write_index(self.index, index_file)
+        with open(texts_file, "w", encoding="utf-8") as f:
+            json.dump(self.texts, f)
+        with open(manifest_file, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+        if self.index_path:
+            faiss.write_index(self.index, self.index_path)
+
+    def _encoder_id(self) -> str:
+        """
+        Identifies which encoder produced an embedding: class name plus the
+        ONNX model path or the SentenceTransformer model name.
+        """
+        return f"{type(self.model).__name__}:{getattr(self.model, 'model_path', self.model_name)}"
+
+    def _chunk_text(self, raw: str, fname: str) -> List[str]:
+        """
+        Slide a CHUNK_TOKENS-wide window (CHUNK_STRIDE step, so adjacent
+        windows overlap) over the tokenized file and decode each window back
+        to text, prefixed with the filename for traceability.
+        """
+        tok = self.model.tokenizer
+        ids = tok.encode(raw, add_special_tokens=False)
+        chunks = []
+        for i in range(0, len(ids), CHUNK_STRIDE):
+            text = tok.decode(ids[i:i + CHUNK_TOKENS]).strip()
+            if text:
+                chunks.append(f"[{fname}] {text}")
+            if i + CHUNK_TOKENS >= len(ids):
+                break
+        return chunks
+
+    def _load_cached_index(self, index_file, texts_file, manifest_file, manifest) -> bool:
+        """
+        If the reference corpus is unchanged since the last build, mmap the
+        saved FAISS index (milliseconds, pages shared across processes) and
+        load the chunk texts; returns True on a usable hit.
+        """
+        if not (os.path.exists(index_file) and os.path.exists(texts_file)
+                and os.path.exists(manifest_file)):
+            return False
+        try:
+            with open(manifest_file, "r", encoding="utf-8") as f:
+                if json.load(f) != manifest:
+                    return False
+            self.index = faiss.read_index(index_file,
+                                          faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            with open(texts_file, "r", encoding="utf-8") as f:
+                self.texts = json.load(f)
+            return True
+        except Exception:
+            return False
+
+    def retrieve(self, query: str, k=4) -> List[Tuple[str, float]]:
+        return self.retrieve_batch([query], k=k)[0]
+
+    def retrieve_batch(self, queries: List[str], k=4) -> List[List[Tuple[str, float]]]:
+        """
+        Encode all queries in one forward pass and run a single FAISS search,
+        instead of one encode+search round-trip per query.
+        """
+        if not queries:
+            return []
+        q_emb = self.model.encode(queries, batch_size=64, convert_to_numpy=True).astype("float32")
+        faiss.normalize_L2(q_emb)
+        self.index.hnsw.efSearch = 32
+        D, I = self.index.search(q_emb, k)
+        results = []
+        for row_i, row_d in zip(I, D):
+            out = []
+            for i, dist in zip(row_i, row_d):
+                if i < 0 or i >= len(self.texts):
+                    continue
+                out.append((self.texts[i], float(dist)))
+            results.append(out)
+        return results